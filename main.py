@@ -1,122 +1,212 @@
-import re
+import operator
+import sys
+from functools import lru_cache
+from itertools import accumulate
 
 import cpmpy as cp
 from cpmpy.solvers.solver_interface import ExitStatus
 
 
+# Character classes; a token is a maximal run of one non-space class
+ATOM_CHARS, DIGIT_CHARS, SPACE_CHARS, OP_CHARS = 'adso'
+
+def char_class(c):
+    if c.isalpha() or c == '$':
+        return ATOM_CHARS
+    elif c.isdigit():
+        return DIGIT_CHARS
+    elif c.isspace():
+        return SPACE_CHARS
+    return OP_CHARS
+
+class CharClassTable(dict):
+    # str.translate() table from code point to class, filled in as characters are seen
+    def __missing__(self, code_point):
+        self[code_point] = char_class(chr(code_point))
+        return self[code_point]
+
+CHAR_CLASSES = CharClassTable()
+
+# Results are cached, so they're returned as a tuple and frozenset that callers can't mutate
+@lru_cache(maxsize=512)
 def tokenize(text):
     tokens = []
     atoms = set()
+    # Classify the whole clue in one C-level pass, then only compare classes here
+    classes = text.translate(CHAR_CLASSES)
     i = 0
     stop_extracting_atoms = False
     extract_atoms = False
     while i < len(text):
-        first_char = text[i]
-        token_matcher = None
+        token_class = classes[i]
         extract_atoms = False
-        if first_char.isalpha() or first_char == '$':
-            token_matcher = r'([$a-zA-Z]+)'
+        if token_class == ATOM_CHARS:
             if not stop_extracting_atoms:
                 extract_atoms = True
-        elif first_char.isdigit():
-            token_matcher = r'([0-9]+)'
-        elif first_char.isspace():
+        elif token_class == SPACE_CHARS:
             i += 1
             continue
-        else:
-            token_matcher = r'([^$a-zA-Z0-9\s]+)'
-        token = re.match(token_matcher, text[i:])[0]
-        i += len(token)
+        j = i + 1
+        while j < len(text) and classes[j] == token_class:
+            j += 1
+        token = text[i:j]
+        i = j
         tokens.append(token)
         if tokens == 'is':
             stop_extracting_atoms = True
             extract_atoms = False
         if extract_atoms:
-            atoms.update(set(token) - set('$'))
+            atoms.update(token.replace('$', ''))
             extract_atoms = False
-    return tokens, atoms
+    return tuple(tokens), frozenset(atoms)
+
+OPS = {
+    '>=': operator.ge,
+    '>': operator.gt,
+    '<=': operator.le,
+    '<': operator.lt,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+}
 
 def use_op(left, right, op):
-    if op == '>=':
-        return left >= right
-    elif op == '>':
-        return left > right
-    elif op == '<=':
-        return left <= right
-    elif op == '<':
-        return left < right
-    elif op == '=' or op == '==':
-        return left == right
-    elif op == '!=' or op == '<>':
-        return left != right
-    else:
-        raise RuntimeError(f'Unsupported ast operator {op}')
+    try:
+        op_func = OPS[op]
+    except KeyError:
+        raise RuntimeError(f'Unsupported ast operator {op}') from None
+    return op_func(left, right)
+
+_VAR_CACHE = {}  # One BoolVar per atom name, shared by every clue
+
+def _bv(s):
+    var = _VAR_CACHE.get(s)
+    if var is None:
+        var = _VAR_CACHE[s] = cp.BoolVar(name=s)
+    return var
 
-def symbols_to_boolvars(symbols):
-    return [cp.BoolVar(name=s) for s in symbols]
+# `abc` is about innocents and `$abc` about criminals, among the same people
+def split_leaf(leaf):
+    if leaf[0] == '$':
+        return False, leaf[1:]
+    return True, leaf
 
 def connected_expr(leaf):
-    innocence, symbols = (False, leaf[1:]) if leaf[0] == '$' else (True, leaf)
+    innocence, symbols = split_leaf(leaf)
     if len(symbols) < 3:
         return True
 
-    atoms = symbols_to_boolvars(symbols)
-    tests_for_failure = []
-    for center_idx in range(1, len(atoms)-1):
-        left = atoms[:center_idx]
-        center = atoms[center_idx]
-        right = atoms[center_idx+1:]
-        fail_test = None
-        if innocence:
-            fail_test = cp.any(left) & (~center) & cp.any(right)
-        else:
-            fail_test = (~cp.all(left)) & center & (~cp.all(right))
-        tests_for_failure.append(fail_test)
+    atoms = [_bv(c) for c in symbols]
+    # Literals that hold for the people who must be connected
+    members = atoms if innocence else [~atom for atom in atoms]
+    # prefix_any[i] is any(members[:i+1]), suffix_any[i] is any(members[i:])
+    prefix_any = list(accumulate(members, operator.or_))
+    suffix_any = list(accumulate(reversed(members), operator.or_))[::-1]
+    tests_for_failure = [prefix_any[center_idx-1] & (~members[center_idx]) & suffix_any[center_idx+1]
+                         for center_idx in range(1, len(members)-1)]
 
     return ~cp.any(tests_for_failure)
 
 def parity_expr(leaf, parity_str):
-    innocence, symbols = (False, leaf[1:]) if leaf[0] == '$' else (True, leaf)
-    atoms = symbols_to_boolvars(symbols)
+    innocence, symbols = split_leaf(leaf)
+    atoms = [_bv(c) for c in symbols]
     count_expr = None
     if innocence:
         count_expr = cp.sum(atoms)
     else:
-        count_expr = len(atoms) - cp.sum(atoms)
+        count_expr = cp.sum([~atom for atom in atoms])
     parity = 1 if (parity_str == 'odd') else 0
     return count_expr%2 == parity
 
 
-def leaf_to_expr(leaf_text):
-    first_char = leaf_text[0]
-    if first_char.isalpha():
-        return cp.sum(symbols_to_boolvars(leaf_text))
-    elif first_char == '$':
-        num_innocent = cp.sum(symbols_to_boolvars(leaf_text[1:]))
-        num_atoms = len(leaf_text) - 1
-        return num_atoms - num_innocent
-    elif first_char.isdigit():
-        return int(leaf_text)
+# A leaf as (literals to count, constant). `$abc` counts ~a, ~b and ~c rather
+# than 3 - (a + b + c), so comparisons stay a plain sum of literals
+def leaf_to_terms(leaf_text):
+    if leaf_text[0] == '$':
+        return [~_bv(c) for c in leaf_text[1:]], 0
+    if leaf_text[0].isdigit():
+        return [], int(leaf_text)
+    return [_bv(c) for c in leaf_text], 0
 
 def combinations_expr(symbols, threshold, op):
-    left_expr = cp.sum(symbols_to_boolvars(symbols))
+    left_expr = cp.sum([_bv(c) for c in symbols])
     right_expr = threshold
     return use_op(left_expr, right_expr, op)
 
-def comparison_expr(left_symbols, right_symbols, op):
-    left_expr = cp.sum(symbols_to_boolvars(left_symbols))
-    right_expr = cp.sum(symbols_to_boolvars(right_symbols))
-    return use_op(left_expr, right_expr, op)
-
-def find_known_facts(model, atomics):
+def comparison_expr(left, right, op):
+    # Move everything to the left as `sum(+x, -y) OP constant`; comparing two sums
+    # directly makes cpmpy introduce an intvar for one side when flattening
+    left_lits, left_const = leaf_to_terms(left)
+    right_lits, right_const = leaf_to_terms(right)
+    constant = right_const - left_const
+    # Fold clues that hold for every or no value the sum can take, e.g. `a >= 2`;
+    # pysat fails to post those as constraints
+    outcomes = {use_op(total, constant, op) for total in range(-len(right_lits), len(left_lits) + 1)}
+    if len(outcomes) == 1:
+        return outcomes.pop()
+    return use_op(cp.sum(left_lits + [-x for x in right_lits]), constant, op)
+
+def canonical_leaf(leaf):
+    if leaf[0].isdigit():
+        return leaf
+    if leaf[0] == '$':
+        return '$' + ''.join(sorted(leaf[1:]))
+    return ''.join(sorted(leaf))
+
+# The same clue always gets the same key, however it was written
+def clue_key(left, op, right):
+    if op == 'is':
+        if right == 'connected':
+            return left, op, right
+        innocence, symbols = split_leaf(left)
+        parity = 1 if (right == 'odd') else 0
+        if not innocence:
+            parity = (len(symbols) - parity) % 2
+        return ''.join(sorted(symbols)), op, ('even', 'odd')[parity]
+    op = {'==': '=', '<>': '!='}.get(op, op)
+    return canonical_leaf(left), op, canonical_leaf(right)
+
+# Atoms pinned down by a single clue like `ab = 2` or `$c = 1`, mapped to their innocence
+def forced_atoms(left, op, right):
+    if op not in ('=', '=='):
+        return {}
+    if left.isdigit():
+        left, right = right, left
+    if not right.isdigit():
+        return {}
+    innocence, symbols = split_leaf(left)
+    if not symbols.isalpha():
+        return {}
+    count = int(right)
+    if count == 0:
+        return dict.fromkeys(symbols, not innocence)
+    if count == len(symbols):
+        return dict.fromkeys(symbols, innocence)
+    return {}
+
+def fact_text(atom, innocent):
+    if innocent:
+        return f'{atom.upper()} is innocent.'
+    return f'{atom.upper()} is a criminal.'
+
+# Expects the solver to hold a solution from its last solve(). That solution is a
+# witness, so an atom is known exactly when it can't be flipped from its witness value.
+def find_known_facts(solver, atomics, forced):
+    witness = {atom: bool(_bv(atom).value()) for atom in atomics}
+    # Phase saving: each probe flips one atom, so the rest of the witness is a good first guess
+    solver.solution_hint([_bv(atom) for atom in witness], list(witness.values()))
+    flipped = set()  # Atoms seen with both values, so they can't be known
     for atom in atomics:
-        if_true = model.copy().add(cp.BoolVar(name=atom))
-        if not if_true.solve():
-            yield f'{atom.upper()} is a criminal.'
+        if atom in forced:
+            yield atom, forced[atom]
+        elif atom in flipped:
+            continue
+        elif not solver.solve(assumptions=[~_bv(atom) if witness[atom] else _bv(atom)]):
+            yield atom, witness[atom]
         else:
-            if_false = model.copy().add(~cp.BoolVar(name=atom))
-            if not if_false.solve():
-                yield f'{atom.upper()} is innocent.'
+            # The new solution may flip other atoms too, which saves probing them
+            flipped.update(a for a in atomics if bool(_bv(a).value()) != witness[a])
 
 
 WELCOME = """Starting a new game. Type "h" for help or "q" for quit."""
@@ -178,60 +268,111 @@ class Exit(Exception):
         self.message = message
         super().__init__(self.message)
 
-def enter_clue():
-    clue_text = input("Enter a clue: ").strip().lower()
+class GameState:
+    def __init__(self):
+        self.all_atomics = set()  # Variable names added to the model so far
+        self.decided = {}  # Atoms whose innocence is known and has been displayed
+        self.forced = {}  # Atoms fixed directly by a clue, mapped to their innocence
+        self.seen_clues = set()  # clue_key() of every clue added to the model
+
+def enter_clue(prompt="Enter a clue: "):
+    clue_text = input(prompt).strip().lower()
     if clue_text in ('h', 'help'):
         raise TryAgain(HELP)
     if clue_text in ('q', 'quit'):
         raise Exit("Goodbye!")
     return clue_text
 
+# Adds a clue to the solver, returning whether there is anything new to solve
+def process_clue(the_truth, clue_text, state):
+    tokens, atomics = tokenize(clue_text)
+    if len(tokens) != 3:
+        raise TryAgain('Syntax error 1')
+    left, op, right = tokens
+    expr = None
+    if op == 'is':
+        if right == 'connected':
+            expr = connected_expr(left)
+        elif right in ['odd', 'even']:
+            expr = parity_expr(left, right)
+        else:
+            raise TryAgain('Syntax error 2')
+
+    else:
+        expr = comparison_expr(left, right, op)
+        clue_forced = forced_atoms(left, op, right)
+        # Unit clues about decided atoms can be settled without the solver
+        if any(state.decided.get(atom, innocent) != innocent for atom, innocent in clue_forced.items()):
+            raise Exit('No solution. Contradiction found.')
+        if clue_forced and clue_forced.keys() <= state.decided.keys():
+            return False
+        state.forced.update(clue_forced)
+    key = clue_key(left, op, right)
+    if key in state.seen_clues:
+        return False
+    state.seen_clues.add(key)
+    state.all_atomics.update(atomics)
+
+    the_truth += expr
+    return True
+
+def report_facts(the_truth, state):
+    _ = the_truth.solve(time_limit=SOLVER_SECONDS)
+    solver_status = the_truth.status()
+    if solver_status.exitstatus == ExitStatus.UNSATISFIABLE:
+        raise Exit('No solution. Contradiction found.')
+    if solver_status.exitstatus == ExitStatus.UNKNOWN:
+        raise Exit(TIMEOUT_WARNING)
+
+    # Clues only ever add constraints, so a decided atom stays decided
+    for atom, innocent in find_known_facts(the_truth, state.all_atomics - state.decided.keys(), state.forced):
+        state.decided[atom] = innocent
+        print(fact_text(atom, innocent))
+
+def play_interactive(the_truth, state):
+    while True:
+        try:
+            if process_clue(the_truth, enter_clue(), state):
+                report_facts(the_truth, state)
+        except TryAgain as e:
+            print(e.message)
+            continue
+
+# Piped input: add every clue first, then solve and report once at the end
+def play_batch(the_truth, state):
+    added = False
+    while True:
+        try:
+            clue_text = enter_clue(prompt="")
+        except TryAgain as e:
+            print(e.message)
+            continue
+        except EOFError:
+            break
+        except Exit:
+            if added:
+                report_facts(the_truth, state)
+            raise
+        try:
+            added |= process_clue(the_truth, clue_text, state)
+        except TryAgain as e:
+            print(e.message)
+            continue
+    if added:
+        report_facts(the_truth, state)
+
+def new_solver():
+    return cp.SolverLookup.get("pysat")
+
 def main():
-    the_truth = cp.Model()
-    all_atomics = set()  # Variable names added to the model so far
-    known_facts = set()  # Results that have already been displayed
+    the_truth = new_solver()
+    state = GameState()
     try:
         print(WELCOME)
-        while True:
-            try:
-                clue_text = enter_clue()
-                tokens, atomics = tokenize(clue_text)
-                if len(tokens) != 3:
-                    raise TryAgain('Syntax error 1')
-                left, op, right = tokens
-                expr = None
-                if op == 'is':
-                    if right == 'connected':
-                        expr = connected_expr(left)
-                    elif right in ['odd', 'even']:
-                        expr = parity_expr(left, right)
-                    else:
-                        raise TryAgain('Syntax error 2')
-
-                else:
-                    expr = use_op(leaf_to_expr(left), leaf_to_expr(right), op)
-                all_atomics.update(atomics)
-
-
-                the_truth += expr
-
-                _ = the_truth.solve(time_limit=SOLVER_SECONDS)
-                solver_status = the_truth.status()
-                if solver_status.exitstatus == ExitStatus.UNSATISFIABLE:
-                    raise Exit('No solution. Contradiction found.')
-                if solver_status.exitstatus == ExitStatus.UNKNOWN:
-                    raise Exit(TIMEOUT_WARNING)
-
-                new_known_facts = set(find_known_facts(the_truth, all_atomics))
-                added_facts = new_known_facts - known_facts
-                known_facts = new_known_facts
-
-                for fact in added_facts:
-                    print(fact)
-
-            except TryAgain as e:
-                print(e.message)
-                continue
+        if sys.stdin.isatty():
+            play_interactive(the_truth, state)
+        else:
+            play_batch(the_truth, state)
     except KeyboardInterrupt:
         pass
     except Exit as e:
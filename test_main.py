@@ -0,0 +1,26 @@
+import itertools
+import unittest
+
+from main import OPS, comparison_expr, new_solver, _bv
+
+
+class SingleAtomClueTest(unittest.TestCase):
+    # Clues like `a >= 2` or `$d >= 0` are decided by the leaf's range alone and
+    # used to crash pysat when posted as a sum
+    def test_single_atom_against_constant(self):
+        for leaf, constant, op in itertools.product(['a', '$a'], '0123', OPS):
+            for left, right in ((leaf, constant), (constant, leaf)):
+                for innocent in (False, True):
+                    with self.subTest(clue=f'{left} {op} {right}', innocent=innocent):
+                        solver = new_solver()
+                        solver += comparison_expr(left, right, op)
+                        count = int(innocent) if leaf == 'a' else 1 - int(innocent)
+                        left_val = count if left == leaf else int(left)
+                        right_val = count if right == leaf else int(right)
+                        atom = _bv('a') if innocent else ~_bv('a')
+                        self.assertEqual(solver.solve(assumptions=[atom]),
+                                         OPS[op](left_val, right_val))
+
+
+if __name__ == '__main__':
+    unittest.main()